@@ -25,37 +25,65 @@ Options:
 # -*- coding: utf-8 -*-
 
 import os
+import atexit
+import hashlib
 import timeit
 from datetime import datetime
+from functools import lru_cache, wraps
 from os.path import exists
 import re
-import inspect
 import math
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import platform
-import applescript
 
+import numpy as np
 import cadquery as cq
 from cadquery import exporters
+from OCP.BOPAlgo import BOPAlgo_Options
+from OCP.BRepAlgoAPI import BRepAlgoAPI_Fuse
+from OCP.BRepBuilderAPI import BRepBuilderAPI_Transform
+from OCP.BRepMesh import BRepMesh_IncrementalMesh
+from OCP.BinTools import BinTools, BinTools_FormatVersion_CURRENT
+from OCP.gp import gp_Ax1, gp_Dir, gp_Pnt, gp_Trsf, gp_Vec
+from OCP.Interface import Interface_Static
+from OCP.OSD import OSD_ThreadPool
+from OCP.StlAPI import StlAPI_Writer
+from OCP.TopAbs import TopAbs_COMPOUND
+from OCP.TopLoc import TopLoc_Location
+from OCP.TopoDS import TopoDS_Builder, TopoDS_Compound, TopoDS_Iterator, TopoDS_Shape
+from OCP.TopTools import TopTools_ListOfShape
+
+# Let every boolean spread its face and edge intersections over all the cores
+BOPAlgo_Options.SetParallelMode_s(True)
+OSD_ThreadPool.DefaultPool_s().Init(os.cpu_count() or -1)
 
 # create the argument parser
 parser = argparse.ArgumentParser(description='My script description')
 
 # add the command-line arguments
-parser.add_argument('--iterations', type=int, help='the number of iterations')
-parser.add_argument('--layer-height', type=float, help='the layer height in mm')
-parser.add_argument('--nozzle-diameter', type=float, help='the nozzle diameter in mm')
-parser.add_argument('--size-multiplier', type=float, help='how much bigger it should be from default')
+parser.add_argument('--iterations', type=int, default=3, help='the number of iterations')
+parser.add_argument('--layer-height', type=float, default=0.2, help='the layer height in mm')
+parser.add_argument('--nozzle-diameter', type=float, default=0.4, help='the nozzle diameter in mm')
+parser.add_argument('--size-multiplier', type=float, default=1.0, help='how much bigger it should be from default')
+parser.add_argument('--step', action='store_true', help='also export the final model as a STEP file')
+parser.add_argument('--step-pcurves', action='store_true', help='keep the surface curves in exported STEP files')
+parser.add_argument('--union-strategy', choices=['chain', 'balanced', 'clustered'], default='clustered', help='how to order the booleans of a union')
 
-# parse the command-line arguments
-args = parser.parse_args()
+# parse the command-line arguments, leaving any that belong to a host like pytest or Jupyter alone
+args = parser.parse_known_args()[0]
 
 NOZZLE_DIAMETER = args.nozzle_diameter
 LAYER_HEIGHT = args.layer_height
 FINAL_ORDER = args.iterations
 SIZE_MULTIPLER = args.size_multiplier
+EXPORT_STEP = args.step
+STEP_PCURVES = args.step_pcurves
+UNION_STRATEGY = args.union_strategy
 
-part_cash = {}
+fractal_levels = {}
+pending_comments = []
 
 GAP_SIZE = 0.01
 EDGE_SIZE = NOZZLE_DIAMETER * 4 * SIZE_MULTIPLER
@@ -67,9 +95,28 @@ FULL_HEIGHT = math.ceil(FULL_SIZE * 0.7071 * 2)
 PYRAMID_HEIGHT = round(EDGE_SIZE * HEIGHT_FACTOR, 2)
 COMBINED_HEIGHT = PYRAMID_HEIGHT + LAYER_HEIGHT
 GAP_HEIGHT = LAYER_HEIGHT + GAP_SIZE * HEIGHT_FACTOR
-PART_CACHE_STEP_DIR = 'part_cache'
+
+# Per-order geometry, indexed by order. The logo needs up to order 3 even for the smallest flakes.
+FACTOR = 2**np.arange(max(FINAL_ORDER, 2) + 2)
+BASE_SIZE = EDGE_SIZE * FACTOR
+HALF_SIZE = BASE_SIZE / 2
+CONE_HEIGHT = PYRAMID_HEIGHT * FACTOR
+HEIGHT_OF = LAYER_HEIGHT + CONE_HEIGHT
+LEVEL_HEIGHT = (COMBINED_HEIGHT + LAYER_HEIGHT) * FACTOR
+CORE_SHIFT = LEVEL_HEIGHT - 2 * LAYER_HEIGHT * FACTOR
+LOGO_ORDER = 1 if FINAL_ORDER < 3 else 2
+
+PART_CACHE_DIR = 'part_cache'
+PART_CACHE_INDEX = f'{PART_CACHE_DIR}/index.tsv'
 PART_CACHE_STL_DIR = 'parts_stl'
 OUTPUT_DIR = 'output'
+STL_TOLERANCE = NOZZLE_DIAMETER / 4  # Anything finer than a quarter nozzle won't show up in the print
+STL_ANGULAR_TOLERANCE = 0.5
+CACHE_VERSION = 3  # Bump whenever the way a cached part is built or stored changes
+CACHE_PREFIX = f'v{CACHE_VERSION}-{round(EDGE_SIZE,2)}-{round(LAYER_HEIGHT,2)}-{round(GAP_SIZE,2)}-{HEIGHT_FACTOR}-{NOZZLE_DIAMETER}-'
+
+_WS_RE = re.compile(r'\s+')
+_IS_MAC = platform.system() == "Darwin"
 
 def report(message, *, time_stamp=True, order=None, extra_line=False):
 
@@ -86,186 +133,390 @@ def report(message, *, time_stamp=True, order=None, extra_line=False):
     print(message)
 
 def remove_blanks(string):
-    pattern = re.compile(r'\s+')
-    return re.sub(pattern, '', string)
+    return _WS_RE.sub('', string)
 
+@lru_cache(maxsize=4096)
 def name_for_cache(part_name, order=None):
-    if order is not None:
-        part_name = f'{part_name}[{order}]'
+    base = f'{part_name}[{order}]' if order is not None else part_name
+    return CACHE_PREFIX + base
+
+class PartCache:
+    """Parts kept in RAM, plus the background writes that are still putting them on disk."""
+
+    def __init__(self):
+        self.parts = {}
+        self.writes = []
+
+    def store(self, part_name, part, *, save=True):
+        self.parts[part_name] = part
+        if save and not exists(cache_file_path(part_name)):
+            # Writing happens in the background so the next level can be built meanwhile
+            self.writes.append(_io_pool.submit(write_cached_part, part, part_name))
 
-    part_name = f'''
-    {str(round(EDGE_SIZE,2))}-
-    {str(round(LAYER_HEIGHT,2))}-
-    {str(round(GAP_SIZE,2))}-
-    {str(HEIGHT_FACTOR)}-
-    {str(NOZZLE_DIAMETER)}-
-    {part_name}
-    '''
+    def clear(self):
+        self.parts = {}
 
-    part_name = remove_blanks(part_name)
+_io_pool = ThreadPoolExecutor(max_workers=2)
+_index_lock = threading.Lock()
+part_cash = PartCache()
 
-    return part_name
+@lru_cache(maxsize=4096)
+def cache_digest(coded_part_name):
+    return hashlib.blake2b(coded_part_name.encode(), digest_size=8).hexdigest()
+
+def cache_file_path(coded_part_name):
+    # Shard on the first two hex digits so no single directory gets too big
+    digest = cache_digest(coded_part_name)
+    return f'{PART_CACHE_DIR}/{digest[:2]}/{digest}.bin'
 
 def get_cached_model(name, order=None):
     part_name = name_for_cache(name, order=order)
 
-    if part_name in part_cash:
+    if part_name in part_cash.parts:
         report(f'   ⭐️ {name}', order=order)
-        return part_cash[part_name]
+        return part_cash.parts[part_name]
 
-    file_path = f'{PART_CACHE_STEP_DIR}/{part_name}.STEP'
+    file_path = cache_file_path(part_name)
     if USE_DISK_CACHE and exists(file_path):
         report(f'   🗃️  load {name}', order=order)
-        part = cq.importers.importStep(file_path)
-        cache_model(part, name, order=order)
+        shape = TopoDS_Shape()
+        BinTools.Read_s(shape, file_path)
+        part = cq.Workplane(obj=cq.Shape.cast(shape))
+        part_cash.store(part_name, part, save=False)
         return part
 
     report(f'   ❌ {name} not found in cache', order=order)
     return None
 
+def write_cached_part(part, part_name):
+    file_path = cache_file_path(part_name)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    report(f'💾 {file_path} ({part_name})')
+
+    # Write next to the final file and move it into place, so a killed run never leaves half a part behind
+    temp_path = f'{file_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    # Leave out any triangulation, the cache only needs the exact geometry
+    if not BinTools.Write_s(part.val().wrapped, temp_path, False, False, BinTools_FormatVersion_CURRENT):
+        raise OSError(f'could not write {temp_path}')
+    os.replace(temp_path, file_path)
+
+    # The file names are hashes, so keep a readable list of what each one holds
+    with _index_lock, open(PART_CACHE_INDEX, 'a', encoding='utf-8') as index:
+        index.write(f'{cache_digest(part_name)}\t{part_name}\n')
+
 def cache_model(part, part_name, order=None):
     coded_part_name = name_for_cache(part_name, order)
-    part_cash[coded_part_name] = part
+    part_cash.store(coded_part_name, part)
     report(f"   📥 {part_name}", order=order)
 
+def disk_cached(name=None, order=None):
+    # Without an explicit order the part is keyed by the maker's order argument
+    def decorator(func):
+        part_name = name or func.__name__
+
+        @wraps(func)
+        def wrapper(*maker_args, **maker_kwargs):
+            part_order = order
+            if part_order is None:
+                part_order = maker_kwargs['order'] if 'order' in maker_kwargs else maker_args[0]
+
+            cached = get_cached_model(part_name, part_order)
+            if cached is not None:
+                return cached
+
+            part = func(*maker_args, **maker_kwargs)
+            cache_model(part, part_name, order=part_order)
+            return part
+
+        return wrapper
+
+    return decorator
+
 def save_comments(file_path, note):
-    if platform.system() == "Darwin":  # Checks if the OS is macOS
+    if _IS_MAC:
         note += f"\nNOZZLE_DIAMETER: {NOZZLE_DIAMETER}"
         note += f"\nLAYER_HEIGHT: {LAYER_HEIGHT}"
         note += f"\nFINAL_ORDER: {FINAL_ORDER}"
         note += f"\nSIZE_MULTIPLER: {SIZE_MULTIPLER}"
-        applescript.tell.app("Finder", f'set comment of (POSIX file "{file_path}" as alias) to "{note}" as Unicode text')
+        pending_comments.append((file_path, note))
+
+def flush_comments():
+    if not pending_comments:
+        return
+
+    # applescript is only installed on macOS, so don't ask for it anywhere else
+    import applescript  # pylint: disable=import-outside-toplevel
+
+    # One osascript call for every file written during the run
+    commands = [
+        f'set comment of (POSIX file "{file_path}" as alias) to "{note}" as Unicode text'
+        for file_path, note in pending_comments
+        ]
+    applescript.run('tell application "Finder"\n' + '\n'.join(commands) + '\nend tell')
+    pending_comments.clear()
+
+atexit.register(flush_comments)
+
+def write_stl(result, file_path):
+    # Meshing writes into faces the background cache writes may still be reading
+    save_caches_to_disk(clear=False)
+
+    shape = result.val().wrapped
+
+    # Mesh the faces in parallel, then write the triangles straight out as binary STL
+    BRepMesh_IncrementalMesh(shape, STL_TOLERANCE, False, STL_ANGULAR_TOLERANCE, True)
+    writer = StlAPI_Writer()
+    writer.ASCIIMode = False
+    writer.Write(shape, file_path)
+
+def _export_svg(result, file_path):
+    exporters.export(
+        result.rotateAboutCenter((0, 0, 1), 135).rotateAboutCenter((0, 1, 0), 90),
+        file_path,
+        opt={
+            "width": 1000,
+            "height": 1000,
+            "marginLeft": 100,
+            "marginTop": 100,
+            "showAxes": True,
+            "projectionDir": (0, 1, 0),
+            "strokeWidth": 0.01,
+            "strokeColor": (0, 0, 0),
+            "hiddenColor": (90, 90, 90),
+            "showHidden": True,
+            },
+        )
 
 def output(result, *, name, path, stl=False, step=False, svg=False):
-    file_path = path
+    base = path
 
-    if file_path != '':
-        if not os.path.exists(file_path):
-            os.makedirs(file_path)
-        file_path += '/'
+    if base != '':
+        if not os.path.exists(base):
+            os.makedirs(base)
+        base += '/'
 
     name = remove_blanks(name)
     if stl:
-        file_path = file_path + name + '.stl'
-        exporters.export(result, file_path)
-        save_comments(file_path, name)
+        target = base + name + '.stl'
+        write_stl(result, target)
+        save_comments(target, name)
 
     if step:
-        file_path = file_path + name + '.STEP'
-        report(f'💾 {file_path}')
-        exporters.export(result, file_path, exporters.ExportTypes.STEP)
-        save_comments(file_path, name)
+        target = base + name + '.STEP'
+        report(f'💾 {target}')
+
+        # Leaving out the surface curves roughly halves the file and its load time. Newer CadQuery
+        # versions reset this setting from write_pcurves, so pass it both ways.
+        Interface_Static.SetIVal_s('write.surfacecurve.mode', int(STEP_PCURVES))
+        exporters.export(result, target, exporters.ExportTypes.STEP, opt={'write_pcurves': STEP_PCURVES})
+        save_comments(target, name)
 
     if svg:
-        file_path = file_path + name + '.svg'
-        report(f'💾 {file_path}')
-        exporters.export(result, file_path)
-
-        exporters.export(
-            result.rotateAboutCenter((0, 0, 1), 135).rotateAboutCenter((0, 1, 0), 90),
-            file_path,
-            opt={
-                "width": 1000,
-                "height": 1000,
-                "marginLeft": 100,
-                "marginTop": 100,
-                "showAxes": True,
-                "projectionDir": (0, 1, 0),
-                "strokeWidth": 0.01,
-                "strokeColor": (0, 0, 0),
-                "hiddenColor": (90, 90, 90),
-                "showHidden": True,
-                },
-            )
+        target = base + name + '.svg'
+        report(f'💾 {target}')
+        _export_svg(result, target)
+
+def _is_empty(shape):
+    return shape.IsNull() or (shape.ShapeType() == TopAbs_COMPOUND and not TopoDS_Iterator(shape).More())
+
+def _unpack(part):
+    shape = part.val()
+    if not isinstance(shape, cq.Shape) or _is_empty(shape.wrapped):
+        return []
+
+    shape = shape.wrapped
+    if shape.ShapeType() != TopAbs_COMPOUND:
+        return [shape]
+
+    children = []
+    iterator = TopoDS_Iterator(shape)
+    while iterator.More():
+        if not _is_empty(iterator.Value()):
+            children.append(iterator.Value())
+        iterator.Next()
+
+    return children
+
+def fuse(part, others):
+    # OCCT won't intersect the shapes inside one compound with each other, so hand it every child separately
+    shapes = [shape for operand in [part] + others for shape in _unpack(operand)]
+    if not shapes:
+        return part
+    if len(shapes) == 1:
+        return cq.Workplane(obj=cq.Shape.cast(shapes[0]))
 
-def save_caches_to_disk(clear=True):
-    global part_cash
-    for part_name, part in part_cash.items():
-        if not exists(f'{PART_CACHE_STEP_DIR}/{part_name}.STEP'):
-            output(result=part, name=part_name, path=PART_CACHE_STEP_DIR, step=True)
+    arguments = TopTools_ListOfShape()
+    arguments.Append(shapes[0])
 
-    if clear:
-        part_cash = {}  # Clear out the ram cache
+    tools = TopTools_ListOfShape()
+    for shape in shapes[1:]:
+        tools.Append(shape)
 
-def make_single_pyramid(order):
-    part_name = inspect.currentframe().f_code.co_name
+    # One n-ary fuse lets OCCT share the intersection work between all operands
+    fuser = BRepAlgoAPI_Fuse()
+    fuser.SetArguments(arguments)
+    fuser.SetTools(tools)
+    fuser.SetRunParallel(True)
+    fuser.Build()
 
-    cached = get_cached_model(part_name, order=order)
-    if cached is not None:
-        return cached
+    return cq.Workplane(obj=cq.Shape.cast(fuser.Shape()).clean())
 
-    report('🔺 make a single pyramid', order=order)
+def _boxes_touch(first, second):
+    return not first.wrapped.IsOut(second.wrapped)
 
-    factor = pow(2, order)
+def _chain_union(parts):
+    result = parts[0]
+    for part in parts[1:]:
+        result = fuse(result, [part])
 
-    base_size = EDGE_SIZE * factor
+    return result
 
-    height = LAYER_HEIGHT + PYRAMID_HEIGHT * factor
+def _balanced_union(parts):
+    # Fuse neighbours pairwise so every round halves the number of parts
+    while len(parts) > 1:
+        parts = [fuse(parts[i], parts[i + 1:i + 2]) for i in range(0, len(parts), 2)]
 
-    pyramid = cq.Workplane('XZ').workplane(
-        offset=-base_size / 2
-        ).moveTo(-base_size / 2, 0).lineTo(base_size / 2,
-                                           0).lineTo(base_size / 2,
-                                                     LAYER_HEIGHT).lineTo(0,
-                                                                          height).lineTo(-base_size / 2,
-                                                                                         LAYER_HEIGHT).close().extrude(base_size)
+    return parts[0]
 
-    pyramid = pyramid.intersect(pyramid.rotateAboutCenter((0, 0, 1), 90))
+def _clustered_union(parts):
+    boxes = [part.val().BoundingBox() for part in parts]
 
-    cache_model(pyramid, part_name, order=order)
+    # Sweep the parts in X then Y order and cluster the ones whose bounding boxes touch
+    clusters = []
+    for i in sorted(range(len(parts)), key=lambda index: (boxes[index].center.x, boxes[index].center.y)):
+        cluster = [i]
+        for other in [other for other in clusters if any(_boxes_touch(boxes[i], boxes[j]) for j in other)]:
+            clusters.remove(other)
+            cluster.extend(other)
+        clusters.append(cluster)
 
-    return pyramid
+    # Only parts in the same cluster can share volume, so the clusters themselves can just be grouped
+    unions = [fuse(parts[cluster[0]], [parts[j] for j in cluster[1:]]) for cluster in clusters]
+    if len(unions) == 1:
+        return unions[0]
 
-def make_ribs(order):
+    return cq.Workplane(obj=cq.Compound.makeCompound([union.val() for union in unions]))
 
-    plane = cq.Workplane('XY')
-    part_name = inspect.currentframe().f_code.co_name
+def union_all(parts):
+    parts = [part for part in parts if _unpack(part)]
+    if len(parts) <= 1:
+        return parts[0] if parts else cq.Workplane('XY')
+
+    if UNION_STRATEGY == 'chain':
+        return _chain_union(parts)
+    if UNION_STRATEGY == 'balanced':
+        return _balanced_union(parts)
+
+    return _clustered_union(parts)
+
+def assemble(parts):
+    assembly = cq.Assembly()
+    for part in parts:
+        assembly.add(part)
+
+    return cq.Workplane(obj=assembly.toCompound())
+
+def _transform(part, trsf):
+    # Without a copy the moved shape shares its geometry with the original
+    return cq.Workplane(obj=cq.Shape.cast(BRepBuilderAPI_Transform(part.val().wrapped, trsf, False).Shape()))
+
+def _shift(part, dx, dy, dz):
+    trsf = gp_Trsf()
+    trsf.SetTranslation(gp_Vec(dx, dy, dz))
+    return _transform(part, trsf)
+
+def make_corners(part, shift, dz):
+    translation = gp_Trsf()
+    translation.SetTranslation(gp_Vec(shift, shift, dz))
+
+    compound = TopoDS_Compound()
+    builder = TopoDS_Builder()
+    builder.MakeCompound(compound)
+
+    # Every level is symmetric under quarter turns, so one corner turned about Z gives the other three.
+    # Each corner is only a location on the same shape, so all four share a single copy of the geometry.
+    shape = part.val().wrapped
+    for degrees in (0, 90, 180, 270):
+        rotation = gp_Trsf()
+        rotation.SetRotation(gp_Ax1(gp_Pnt(0, 0, 0), gp_Dir(0, 0, 1)), math.radians(degrees))
+        builder.Add(compound, shape.Moved(TopLoc_Location(rotation.Multiplied(translation))))
+
+    return cq.Workplane(obj=cq.Shape.cast(compound))
+
+def save_caches_to_disk(clear=True):
+    # The writes were started by cache_model, so just wait for them to finish
+    for write in part_cash.writes:
+        write.result()
+
+    part_cash.writes = []
+
+    if clear:
+        part_cash.clear()  # Clear out the ram cache
 
-    cached = get_cached_model(part_name, order=order)
-    if cached is not None:
-        return cached
+def make_polygon_face(points):
+    return cq.Face.makeFromWires(cq.Wire.makePolygon(points + points[:1]))
+
+@lru_cache(maxsize=None)
+def make_single_pyramid(order):
+    report('🔺 make a single pyramid', order=order)
+
+    height = HEIGHT_OF[order]
+    half_size = HALF_SIZE[order]
+
+    # A square pyramid sitting on a one layer slab, built straight from its nine faces
+    corners = [(-half_size, -half_size), (half_size, -half_size), (half_size, half_size), (-half_size, half_size)]
+    bottom = [cq.Vector(x, y, 0) for x, y in corners]
+    top = [cq.Vector(x, y, LAYER_HEIGHT) for x, y in corners]
+    apex = cq.Vector(0, 0, height)
+
+    faces = [make_polygon_face(bottom)]
+    for i in range(4):
+        j = (i + 1) % 4
+        faces.append(make_polygon_face([bottom[i], bottom[j], top[j], top[i]]))
+        faces.append(make_polygon_face([top[i], top[j], apex]))
+
+    return cq.Workplane(obj=cq.Solid.makeSolid(cq.Shell.makeShell(faces)))
+
+@lru_cache(maxsize=None)
+def make_ribs(order):
+    plane = cq.Workplane('XY')
 
     report('🩻  make some ribs', order=order)
 
     rib = plane.workplane(offset=-LAYER_HEIGHT
                          ).rect(RIB_WIDTH,
-                                RIB_WIDTH * 2).extrude(EDGE_SIZE * pow(2, order) + LAYER_HEIGHT).faces('<Z').workplane(20).split(
+                                RIB_WIDTH * 2).extrude(BASE_SIZE[order] + LAYER_HEIGHT).faces('<Z').workplane(20).split(
                                     keepBottom=True
                                     ).rotateAboutCenter((0, 0, 1), 45).rotate(
                                         axisStartPoint=(0, 0, 0), axisEndPoint=(1, 1, 0), angleDegrees=45
-                                        ).translate((0, 0, LAYER_HEIGHT)).intersect(make_single_pyramid(order=order))
+                                        ).translate((0, 0, LAYER_HEIGHT))
 
-    two_ribs = rib.union(rib.mirror(mirrorPlane='ZY'))
-    four_ribs = two_ribs.union(two_ribs.mirror(mirrorPlane='ZX'))
+    # The pyramid is symmetric in both mirror planes, so fuse all four ribs first and trim them just once
+    mirrored = rib.mirror(mirrorPlane='ZY')
+    ribs = fuse(rib, [mirrored, rib.mirror(mirrorPlane='ZX'), mirrored.mirror(mirrorPlane='ZX')])
+    return ribs.intersect(make_single_pyramid(order=order))
 
-    cache_model(four_ribs, part_name, order=order)
-    return four_ribs
+@lru_cache(maxsize=1)
+def _logo_shape():
+    return cq.importers.importStep("logo_stamp.step").val()
 
+@disk_cached(name=f'make_logo[{LOGO_ORDER}]', order=FINAL_ORDER)
 def make_logo():
-    size = 1 if FINAL_ORDER < 3 else 2
-    part_name = inspect.currentframe().f_code.co_name
-    part_name = f'{part_name}[{size}]'
-
-    cached = get_cached_model(part_name, order=FINAL_ORDER)
-    if cached is not None:
-        return cached
+    size = LOGO_ORDER
 
     report('🧠 make the logo', order=FINAL_ORDER)
 
-    factor = pow(2, size)
-    final_factor = pow(2, FINAL_ORDER)
-
-    z_shift_to_top = (PYRAMID_HEIGHT * final_factor) - (PYRAMID_HEIGHT * factor)
+    z_shift_to_top = CONE_HEIGHT[FINAL_ORDER] - CONE_HEIGHT[size]
 
     if FINAL_ORDER == 1:
         z_shift = z_shift_to_top
         shift = 0
     else:
-        z_shift = z_shift_to_top - (PYRAMID_HEIGHT * factor)
+        z_shift = z_shift_to_top - CONE_HEIGHT[size]
 
-        shift = EDGE_SIZE / 2 * factor
+        shift = HALF_SIZE[size]
 
-    box_size = EDGE_SIZE * pow(2, size + 1)
+    box_size = BASE_SIZE[size + 1]
 
     box = (
         cq.Workplane('XY').box(box_size, box_size, box_size).translate(
@@ -273,130 +524,122 @@ def make_logo():
             ).rotate(axisStartPoint=(0, 0, 0), axisEndPoint=(0, 0, 1), angleDegrees=-45)
         )
 
-    move_multiplier = factor * EDGE_SIZE / 2
-    scale_multiplier = factor * EDGE_SIZE / 2
+    move_multiplier = HALF_SIZE[size]
+    scale_multiplier = HALF_SIZE[size]
 
-    logo = cq.importers.importStep("logo_stamp.step").val().scale(scale_multiplier * 0.35)
+    logo = _logo_shape().scale(scale_multiplier * 0.35)
 
-    result = (
-        make_single_pyramid(order=size).intersect(box).union(
-            logo.translate((move_multiplier * 0.8, move_multiplier * -0.4, move_multiplier * 0.25))
-            ).translate((shift, shift, z_shift))
+    stamp = _shift(
+        cq.Workplane(obj=logo),
+        move_multiplier * 0.8 + shift,
+        move_multiplier * -0.4 + shift,
+        move_multiplier * 0.25 + z_shift,
         )
 
-    cache_model(result, part_name, order=FINAL_ORDER)
-    return result
+    return union_all([_shift(make_single_pyramid(order=size).intersect(box), shift, shift, z_shift), stamp])
 
+@lru_cache(maxsize=None)
 def make_gaps(order):
     plane = cq.Workplane('XY')
 
-    part_name = inspect.currentframe().f_code.co_name
-    cached = get_cached_model(part_name, order)
-    if cached is not None:
-        return cached
-
     report('⚔️  make the gaps', order=order)
 
-    base_size = EDGE_SIZE * pow(2, order)
-
-    gaps = plane.rect(base_size, GAP_SIZE).extrude(GAP_HEIGHT).union(plane.rect(GAP_SIZE, base_size).extrude(GAP_HEIGHT))
+    half_size = HALF_SIZE[order]
+    half_gap = GAP_SIZE / 2
+
+    # Trace the outline of the plus sign so it takes one extrude rather than a union of two bars
+    outline = [
+        (-half_size, -half_gap),
+        (-half_gap, -half_gap),
+        (-half_gap, -half_size),
+        (half_gap, -half_size),
+        (half_gap, -half_gap),
+        (half_size, -half_gap),
+        (half_size, half_gap),
+        (half_gap, half_gap),
+        (half_gap, half_size),
+        (-half_gap, half_size),
+        (-half_gap, half_gap),
+        (-half_size, half_gap),
+        ]
+
+    return plane.polyline(outline).close().extrude(GAP_HEIGHT)
+
+def combine_clones(result, order):
+    shift = HALF_SIZE[order - 1]
+    core_shift = CORE_SHIFT[order - 1]
 
-    cache_model(gaps, part_name, order)
-    return gaps
+    report('👯 make clones', order=order)
 
-def make_fractal_pyramid(order):
-    part_name = inspect.currentframe().f_code.co_name
+    core = _shift(result, 0, 0, core_shift)
+    mirror = _shift(result.mirror(mirrorPlane='XY'), 0, 0, LAYER_HEIGHT + core_shift)
+    clones = [mirror, make_corners(result, shift, 0)]
 
-    cached = get_cached_model(part_name, order)
-    if cached is not None:
-        return cached
+    report('💎 combine clones and parts', order=order)
 
-    if order == 0:
-        result = make_single_pyramid(0)
-        cache_model(result, part_name, order=order)
-        return result
+    return union_all([union_all([core, *clones]).cut(make_gaps(order)), make_ribs(order)])
 
-    result = make_fractal_pyramid(order=order - 1)
+def find_fractal_level(part_name, order):
+    if order not in fractal_levels:
+        cached = get_cached_model(part_name, order)
+        if cached is not None:
+            fractal_levels[order] = cached
 
-    save_caches_to_disk()
+    return fractal_levels.get(order)
 
-    factor = pow(2, order - 1)
-    shift = EDGE_SIZE / 2 * factor
-    height = (COMBINED_HEIGHT + LAYER_HEIGHT) * factor
-    layer_height_2 = LAYER_HEIGHT * 2
-    z_shift = (layer_height_2) - height
+def build_fractal_levels(order):
+    part_name = make_fractal_pyramid.__name__
 
-    report('👯 make clones', order=order)
-    mirror = result.mirror(mirrorPlane='XY').translate((0, 0, LAYER_HEIGHT))
-    south = result.translate((-shift, shift, z_shift))
-    north = result.translate((shift, -shift, z_shift))
-    east = result.translate((shift, shift, z_shift))
-    west = result.translate((-shift, -shift, z_shift))
+    # Walk down to the highest level already in memory or on disk, then build back up from there
+    start = order
+    while start > 0 and find_fractal_level(part_name, start) is None:
+        start -= 1
 
-    new_ribs = make_ribs(order=order)
-    new_gaps = make_gaps(order=order)
+    if find_fractal_level(part_name, start) is None:
+        fractal_levels[0] = make_single_pyramid(0)
+        cache_model(fractal_levels[0], part_name, order=0)
 
-    report('💎 combine clones and parts', order=order)
+    for level in range(start + 1, order + 1):
+        fractal_levels[level] = combine_clones(fractal_levels[level - 1], level)
+        cache_model(fractal_levels[level], part_name, order=level)
 
-    result = (
-        result.union(mirror).translate((0, 0, (factor - 1) * -layer_height_2)
-                                      ).union(south).union(west).union(north).union(east).translate(
-                                          (0, 0, height - layer_height_2)
-                                          ).cut(new_gaps).union(new_ribs)
-        )
+def make_fractal_pyramid(order):
+    if order not in fractal_levels:
+        build_fractal_levels(order)
 
-    cache_model(result, part_name, order=order)
-    return result
+    return fractal_levels[order]
 
+@lru_cache(maxsize=None)
+@disk_cached(order=FINAL_ORDER)
 def make_final_mirror():
-    part_name = inspect.currentframe().f_code.co_name
-
-    cached = get_cached_model(part_name, order=FINAL_ORDER)
-    if cached is not None:
-        return cached
     report('🪩  make final mirror', order=FINAL_ORDER)
     pyramid_fractal = make_fractal_pyramid(order=FINAL_ORDER)
-    mirrored = pyramid_fractal.mirror(mirrorPlane='XY').translate((0, 0, LAYER_HEIGHT))
-    cache_model(mirrored, part_name, order=FINAL_ORDER)
-    return mirrored
+    return pyramid_fractal.mirror(mirrorPlane='XY').translate((0, 0, LAYER_HEIGHT))
 
+@lru_cache(maxsize=None)
+@disk_cached()
 def make_stand(order):
-    part_name = inspect.currentframe().f_code.co_name
-
-    cached = get_cached_model(part_name, order)
-    if cached is not None:
-        return cached
-
     cached_pyramid = make_fractal_pyramid(order)
     if cached_pyramid is not None:
         result = cached_pyramid
 
-    factor = pow(2, order)
-    base_size = EDGE_SIZE * factor
-
     report('🧍🏻‍♀️ make a stand', order=order)
 
-    factor = pow(2, order)
-    shift = EDGE_SIZE / 2 * factor
-    south = result.translate((-shift, shift, 0))
-    north = result.translate((shift, -shift, 0))
-    east = result.translate((shift, shift, 0))
-    west = result.translate((-shift, -shift, 0))
+    shift = HALF_SIZE[order]
+    corners = fuse(make_corners(result, shift, 0), [])
     new_gaps = make_gaps(order=order + 1)
     new_ribs = make_ribs(order=order + 1)
 
-    base_size = EDGE_SIZE * pow(2, order + 1)
+    base_size = BASE_SIZE[order + 1]
 
     solid_base = cq.Workplane('XY').rect(base_size, base_size).extrude(0.2)
-    stand = north.union(east).union(south).union(west).cut(new_gaps).union(new_ribs).union(solid_base)
-
-    cache_model(stand, part_name, order=order)
-    return stand
+    return union_all([corners.cut(new_gaps), new_ribs, solid_base])
 
 def export_pyramid():
-    base_size = EDGE_SIZE * pow(2, FINAL_ORDER)
+    base_size = BASE_SIZE[FINAL_ORDER]
     solid_base = cq.Workplane('XY').rect(base_size, base_size).extrude(0.2)
-    pyramid_with_base = make_branded_pyramid().union(solid_base)
+    # An STL slicer merges overlapping shells itself, so the base plate doesn't need a boolean
+    pyramid_with_base = assemble([make_branded_pyramid(), solid_base])
 
     pyramid_name = (
         f'Sierpinski-Pyramid-{FINAL_ORDER}_{round(FULL_HEIGHT/2)}mm_for_{round(LAYER_HEIGHT, 2)}mm_layer_height_and_{round(NOZZLE_DIAMETER, 2)}mm_nozzle'
@@ -405,62 +648,31 @@ def export_pyramid():
     pyramid_name = remove_blanks(pyramid_name)
     output(pyramid_with_base, name=pyramid_name, path=directory, stl=True)
 
+@lru_cache(maxsize=None)
+@disk_cached(order=FINAL_ORDER)
 def make_branded_pyramid():
-
     report('👷🏻‍♀️ About to make a branded pyramid', order=FINAL_ORDER)
+    return union_all([make_fractal_pyramid(order=FINAL_ORDER), make_logo()])
 
-    part_name = inspect.currentframe().f_code.co_name
-
-    cached = get_cached_model(part_name, FINAL_ORDER)
-    if cached is not None:
-        return cached
-
-    branded_pyramid = make_fractal_pyramid(order=FINAL_ORDER).union(make_logo())
-    cache_model(branded_pyramid, part_name, order=FINAL_ORDER)
-    return branded_pyramid
-
-def make_unbranded_pyramid():
-    report('👷🏻‍♀️ About to make an unbranded pyramid', order=FINAL_ORDER)
-
-    part_name = inspect.currentframe().f_code.co_name
-
-    cached = get_cached_model(part_name, FINAL_ORDER)
-    if cached is not None:
-        return cached
-
-    fractal_pyramid = make_fractal_pyramid(order=FINAL_ORDER)
-
-    report('👷🏻‍♀️ finished fractaling! now we brand and combine...', order=FINAL_ORDER)
-
-    save_caches_to_disk(clear=False)
-
-    cache_model(fractal_pyramid, part_name, order=FINAL_ORDER)
-    return fractal_pyramid
-
-def make_octahedron_fractal(branded=True):
-    part_name = inspect.currentframe().f_code.co_name
-    part_name = f'{part_name}-'
-
-    cached = get_cached_model(part_name, order=FINAL_ORDER)
-    if cached is not None:
-        return cached
-
+@disk_cached(name='make_octahedron_fractal-fused' if EXPORT_STEP else 'make_octahedron_fractal-', order=FINAL_ORDER)
+def make_octahedron_fractal():
     report('💠  make it!', order=FINAL_ORDER)
 
-    save_caches_to_disk()
-    stand = None
-
-    pyramid = make_branded_pyramid() if branded else make_unbranded_pyramid()
+    pyramid = make_branded_pyramid()
     export_pyramid()
     mirrored = make_final_mirror()
     stand = make_stand(max(0, FINAL_ORDER - 2))
-    save_caches_to_disk()
 
     report('🔗 combine with mirrored and stand', order=FINAL_ORDER)
 
-    result = (pyramid.union(mirrored).translate((0, 0, PYRAMID_HEIGHT * pow(2, FINAL_ORDER))).union(stand))
+    # The STL only needs the triangles of each part, so only a STEP export pays for fusing the halves
+    if EXPORT_STEP:
+        flake = _shift(union_all([pyramid, mirrored]), 0, 0, CONE_HEIGHT[FINAL_ORDER])
+        result = assemble([flake, stand])
+    else:
+        halves = assemble([pyramid, mirrored])
+        result = assemble([_shift(halves, 0, 0, CONE_HEIGHT[FINAL_ORDER]), stand])
 
-    cache_model(result, part_name, order=FINAL_ORDER)
     return result
 
 def run():
@@ -471,6 +683,7 @@ def run():
     report(f'full height: {str(FULL_HEIGHT)}')
     report(f'edge size: {EDGE_SIZE}')
 
+    # The fractal levels get built on demand, so a cached flake never touches them
     flake = make_octahedron_fractal()  # .rotateAboutCenter((0, 0, 1), 45)
     save_caches_to_disk()
 
@@ -478,7 +691,7 @@ def run():
     name = remove_blanks(name)
 
     directory = f'{OUTPUT_DIR}/{round(NOZZLE_DIAMETER,2)}mm_nozzle/{round(LAYER_HEIGHT,2)}mm_layer_height/'
-    output(flake, name=name, path=directory, stl=True)
+    output(flake, name=name, path=directory, stl=True, step=EXPORT_STEP)
 
     report('DONE!')
 
@@ -491,4 +704,5 @@ def run():
     else:
         report(f"Elapsed time: {round(seconds_elapsed/60/60,2)} hours")
 
-run()
+if __name__ == "__main__":
+    run()